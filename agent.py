@@ -1,14 +1,18 @@
 import asyncio
+import atexit
+import contextlib
 
 from semantic_kernel import Kernel
 from semantic_kernel.utils.logging import setup_logging
 from semantic_kernel.functions import kernel_function
 from semantic_kernel.connectors.ai.open_ai import AzureChatCompletion
-from semantic_kernel.connectors.ai.ollama import OllamaChatCompletion
+from semantic_kernel.connectors.ai.ollama import OllamaChatCompletion, OllamaTextEmbedding
 from semantic_kernel.connectors.ai.function_choice_behavior import FunctionChoiceBehavior
 from semantic_kernel.connectors.ai.chat_completion_client_base import ChatCompletionClientBase
 from semantic_kernel.contents.chat_history import ChatHistory
+from semantic_kernel.contents.utils.author_role import AuthorRole
 from semantic_kernel.functions.kernel_arguments import KernelArguments
+from semantic_kernel.filters import FilterTypes, FunctionInvocationContext
 from semantic_kernel.contents import ChatMessageContent, StreamingChatMessageContent, FunctionCallContent, FunctionResultContent
 
 from semantic_kernel.connectors.ai.open_ai.prompt_execution_settings.azure_chat_prompt_execution_settings import (
@@ -16,12 +20,388 @@ from semantic_kernel.connectors.ai.open_ai.prompt_execution_settings.azure_chat_
 )
 
 from semantic_kernel.connectors.mcp import MCPStreamableHttpPlugin, MCPSsePlugin
+from mcp import types as mcp_types
 
 import logging
+import functools
+import hashlib
+import io
 import json
+import operator
 import os
+import sys
+import threading
+import time
+import weakref
+import importlib.util
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from urllib.parse import urlparse
+
+import httpx
+from ollama import AsyncClient as OllamaAsyncClient
+import numpy as np
 from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
+# Resolved once; getLogger takes the logging module lock on every call
+_SK_LOGGERS = tuple(
+    logging.getLogger(name) for name in ("semantic_kernel", "semantic_kernel.kernel", "semantic_kernel.connectors")
+)
+# Bound once for the per-turn error paths
+_log_exc = logger.exception
+
+
+# Set up a basic console handler once, if not already configured; Agent._setup_logging only sets levels
+if not logging.getLogger().handlers:
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib encoder
+    orjson = None
+
+
+def _json_dumps(obj, sort_keys: bool = False, indent: bool = False) -> bytes:
+    """Serialize `obj` to JSON bytes, preferring orjson when it is installed.
+
+    With indent=True the output is pretty-printed with two-space indentation.
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0) | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, default=str, option=option)
+    return json.dumps(obj, default=str, sort_keys=sort_keys, indent=2 if indent else None, ensure_ascii=False).encode()
+
+
+@functools.lru_cache(maxsize=16)
+def _load_env_file(path: str) -> bool:
+    """Load a .env file into the process environment once per absolute path."""
+    return load_dotenv(path)
+
+
+# Streamed text is flushed to the caller once this many chunks have been handled or
+# this many seconds have passed since the last flush, whichever comes first, even
+# when no further chunk arrives in the meantime.
+_FLUSH_CHUNKS = 16
+_FLUSH_INTERVAL = 0.02
+# Queued by _drain_into once the stream is exhausted
+_STREAM_END = object()
+
+# Default number of entries kept in the response cache before the least recently used is evicted.
+_CACHE_MAXSIZE = 512
+# Seconds allowed for connecting to, or closing, a single MCP server
+_MCP_TIMEOUT = 30
+
+# Which part of the response the stream is currently in; a header is emitted on change
+SECTION_NONE, SECTION_MSG, SECTION_TOOLS, SECTION_THOUGHTS = range(4)
+# Header streamed when entering each section, indexed by section
+_HEADERS = (
+    "",
+    "\n--- Agent Message ---\n",
+    "\n--- Agent Tools ---\n",
+    "\n--- Agent Thoughts ---\n",
+)
+
+# On-disk cache of MCP tool listings; bump the version when the file layout changes
+_TOOLS_CACHE_DIR = Path.home() / ".cache" / "sk_mcp"
+_TOOLS_CACHE_VERSION = 1
+
+
+_get_message = operator.itemgetter("message")
+
+
+def _ollama_parts(inner_content):
+    """Return (thinking, tool_calls) of a raw Ollama chat response, or (None, None) for anything else."""
+    if inner_content is None:
+        return None, None
+    try:
+        msg = _get_message(inner_content)
+    except (KeyError, TypeError):
+        return None, None
+    return getattr(msg, "thinking", None), getattr(msg, "tool_calls", None)
+
+
+def _classify_server_url(server_url: str) -> str | None:
+    """Infer the MCP transport from a server URL path ending in /mcp or /sse."""
+    path = urlparse(server_url).path.rstrip("/")
+    if path.endswith("/mcp"):
+        return "http"
+    if path.endswith("/sse"):
+        return "sse"
+    return None
+
+# HTTP/2 lets several MCP streams to the same host share one connection, but needs h2
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+async def _until_deadline(stream, timeout: float | None, stall_timeout: float | None = None):
+    """Yield from the async generator `stream`, raising TimeoutError once `timeout` seconds have passed.
+
+    The deadline is absolute: it is fixed when iteration starts, so time the consumer
+    spends between items counts toward it too. TimeoutError is also raised when a
+    single item takes longer than `stall_timeout` seconds to arrive. `stream` is closed
+    however iteration ends (exhaustion, timeout, cancellation or the consumer closing
+    this generator).
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    try:
+        while True:
+            wait_until = deadline
+            if stall_timeout is not None:
+                stall_at = loop.time() + stall_timeout
+                wait_until = stall_at if deadline is None else min(deadline, stall_at)
+            async with asyncio.timeout_at(wait_until):
+                try:
+                    item = await anext(stream)
+                except StopAsyncIteration:
+                    return
+            yield item
+    finally:
+        await stream.aclose()
+
+
+async def _drain_into(stream, queue: asyncio.Queue):
+    """Put every item of the async generator `stream` on `queue`, then _STREAM_END.
+
+    An exception raised by `stream` is queued in place of _STREAM_END. Run as a single
+    task, so the stream is opened, iterated and closed in the same task however the
+    reader stops (SK's tracing context must be entered and left in one task).
+    """
+    try:
+        async with contextlib.aclosing(stream):
+            async for item in stream:
+                queue.put_nowait(item)
+    except Exception as exc:
+        queue.put_nowait(exc)
+    else:
+        queue.put_nowait(_STREAM_END)
+
+
+class _SharedTransport(httpx.AsyncBaseTransport):
+    """Route a client's requests through the agent's shared connection pool.
+
+    The MCP transports close their httpx client when a session ends; closing this
+    wrapper leaves the shared pool open. The pool is closed by Agent.aclose().
+    """
+
+    def __init__(self, pool: httpx.AsyncBaseTransport):
+        self._pool = pool
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._pool.handle_async_request(request)
+
+    async def aclose(self) -> None:
+        pass
+
+
+class _ToolListCacheMixin:
+    """Persist an MCP server's list_tools() result on disk so warm starts skip the round trip.
+
+    The listing is reused, from memory or disk, for `tools_cache_ttl` seconds (0
+    disables the cache) and is refetched whenever the server sends a
+    tools/list_changed notification. Tool registration itself is left to
+    MCPPluginBase.load_tools, which is handed the cached listing.
+    """
+
+    tools_cache_ttl: float = 300
+    _tool_list: mcp_types.ListToolsResult | None = None
+    _tool_list_expires: float = 0.0
+
+    def _tools_cache_path(self) -> Path:
+        return _TOOLS_CACHE_DIR / f"tools_{hashlib.sha1(self.url.encode()).hexdigest()}.json"
+
+    def _read_tools_cache(self):
+        """Return (listing, age in seconds) from the disk cache, or None if it is missing or stale."""
+        path = self._tools_cache_path()
+        try:
+            age = time.time() - path.stat().st_mtime
+            if age >= self.tools_cache_ttl:
+                return None
+            data = json.loads(path.read_bytes())
+            if data.get("version") != _TOOLS_CACHE_VERSION or data.get("protocol") != mcp_types.LATEST_PROTOCOL_VERSION:
+                return None
+            return mcp_types.ListToolsResult.model_validate(data["result"]), age
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_tools_cache(self, tool_list: mcp_types.ListToolsResult):
+        path = self._tools_cache_path()
+        data = {
+            "version": _TOOLS_CACHE_VERSION,
+            "protocol": mcp_types.LATEST_PROTOCOL_VERSION,
+            "url": self.url,
+            "result": tool_list.model_dump(mode="json", by_alias=True, exclude_none=True),
+        }
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(_json_dumps(data))
+        except OSError as e:
+            logger.warning("Could not write MCP tools cache %s: %s", path, e)
+
+    async def list_tools(self, refresh: bool = False) -> mcp_types.ListToolsResult:
+        """Return the server's tools from memory, the disk cache or the server, in that order."""
+        now = time.monotonic()
+        if not refresh and self._tool_list is not None and now < self._tool_list_expires:
+            return self._tool_list
+        cached = None if refresh or not self.tools_cache_ttl else self._read_tools_cache()
+        if cached is not None:
+            tool_list, age = cached
+        else:
+            tool_list, age = await self.session.list_tools(), 0.0
+            if self.tools_cache_ttl:
+                self._write_tools_cache(tool_list)
+        self._tool_list = tool_list
+        self._tool_list_expires = now + self.tools_cache_ttl - age
+        return tool_list
+
+    async def load_tools(self, refresh: bool = False):
+        """Register the server's tools through MCPPluginBase.load_tools, fed from list_tools()."""
+        session = self.session
+        try:
+            tool_list = await self.list_tools(refresh=refresh)
+        except Exception as e:
+            logger.warning("Could not list tools of MCP server %s: %s", self.name, e)
+            await super().load_tools()
+            return
+
+        async def cached_list_tools(cursor=None):
+            if cursor is not None:
+                return await type(session).list_tools(session, cursor)
+            return tool_list
+
+        # Only swapped in while the base class registers the tools; the session's own
+        # list_tools() calls (e.g. for output schema validation) still reach the server
+        session.list_tools = cached_list_tools
+        try:
+            await super().load_tools()
+        finally:
+            del session.list_tools
+
+    async def message_handler(self, message):
+        if isinstance(message, mcp_types.ServerNotification) and message.root.method == "notifications/tools/list_changed":
+            await self.load_tools(refresh=True)
+            return
+        await super().message_handler(message)
+
+
+class _CancellableConnectMixin:
+    """Release a half-open MCP connection when the background connect task is cancelled.
+
+    MCPPluginBase only closes its exit stack on errors, not on cancellation, and the
+    transports can only be closed from the task that opened them, so that happens here.
+    """
+
+    async def _inner_connect(self, ready_event: asyncio.Event) -> None:
+        try:
+            await super()._inner_connect(ready_event)
+        except asyncio.CancelledError:
+            await self._exit_stack.aclose()
+            raise
+
+
+class CachedMCPStreamableHttpPlugin(_CancellableConnectMixin, _ToolListCacheMixin, MCPStreamableHttpPlugin):
+    """MCPStreamableHttpPlugin whose tool listing is cached on disk."""
+
+    def __init__(self, *args, tools_cache_ttl: float = 300, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tools_cache_ttl = tools_cache_ttl
+
+
+class CachedMCPSsePlugin(_CancellableConnectMixin, _ToolListCacheMixin, MCPSsePlugin):
+    """MCPSsePlugin whose tool listing is cached on disk."""
+
+    def __init__(self, *args, tools_cache_ttl: float = 300, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tools_cache_ttl = tools_cache_ttl
+
+
+# MCP plugin class for each server "type" in the agent definition
+_PLUGIN_CLASSES = {
+    "http": CachedMCPStreamableHttpPlugin,
+    "sse": CachedMCPSsePlugin,
+}
+
+
+class SemanticCache:
+    """Answer cache matched on the meaning of the user's input rather than its exact text.
+
+    Inputs are embedded and compared against earlier ones by cosine similarity; the
+    stored answer of the closest earlier input is reused when the similarity reaches
+    `threshold`. Entries are only compared within the same `partition` (the model,
+    settings and tools they were answered with). Embeddings are kept L2-normalized in
+    one float32 matrix so a lookup is a single matrix-vector product.
+    """
+
+    def __init__(self, embedding_service, threshold: float = 0.95, maxsize: int = _CACHE_MAXSIZE):
+        self.embedding_service = embedding_service
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self._embeddings = None
+        self._entries = []
+        # Small integer id per partition key, one per row of _embeddings
+        self._partition_ids = {}
+        self._partitions = np.empty(0, dtype=np.int32)
+
+    async def embed(self, text: str) -> np.ndarray:
+        """Embed `text` and return it as a unit-length float32 vector."""
+        vector = np.asarray((await self.embedding_service.generate_embeddings([text]))[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, query: np.ndarray, partition: str):
+        """Return the entry stored for the most similar earlier input in `partition`, or None if none is close enough."""
+        pid = self._partition_ids.get(partition)
+        if pid is None or not self._entries:
+            return None
+        similarities = self._embeddings @ query
+        similarities[self._partitions != pid] = -np.inf
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        return self._entries[best]
+
+    def add(self, query: np.ndarray, entry, partition: str):
+        """Store `entry` under `query` in `partition`, dropping the oldest entry once `maxsize` is exceeded."""
+        pid = self._partition_ids.setdefault(partition, len(self._partition_ids))
+        if self._embeddings is None:
+            self._embeddings = query[np.newaxis, :]
+        else:
+            self._embeddings = np.vstack((self._embeddings, query))
+        self._partitions = np.append(self._partitions, np.int32(pid))
+        self._entries.append(entry)
+        if len(self._entries) > self.maxsize:
+            self._embeddings = self._embeddings[1:]
+            self._partitions = self._partitions[1:]
+            del self._entries[0]
+
+
+@dataclass(slots=True)
+class _TurnAccum:
+    """What a turn has produced so far; converted to the returned dict by to_dict()."""
+
+    thoughts: io.StringIO = field(default_factory=io.StringIO)
+    tool_calls: list = field(default_factory=list)
+    messages: io.StringIO = field(default_factory=io.StringIO)
+
+    def to_dict(self) -> dict:
+        return {
+            "thoughts": self.thoughts.getvalue(),
+            "tool_calls": self.tool_calls,
+            "messages": self.messages.getvalue(),
+        }
+
+
+def _save_history_at_exit(agent_ref):
+    """atexit hook saving an agent's conversation, if the agent is still alive."""
+    agent = agent_ref()
+    if agent is not None:
+        agent.save_history()
 
 
 class Agent:
@@ -30,9 +410,21 @@ class Agent:
         self.kernel = Kernel()
         self._setup_chat_completion(agent_definition)
         self.kernel.add_service(self.chat_completion)
+        # Resolve the per-chunk handler once rather than re-checking the service type per chunk
+        if isinstance(self.chat_completion, AzureChatCompletion):
+            self._chunk_handler = self._handle_azure_chunk
+        else:
+            self._chunk_handler = self._handle_ollama_chunk
 
 
         self.mcp_server_objects = []
+        # One connection pool shared by every MCP server so servers on the same host reuse connections
+        self._http_transport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            http2=_HTTP2_AVAILABLE,
+        )
+        # list_tools() results keyed by server name; refreshed via refresh_tools()
+        self.available_tools = {}
 
         self._setup_logging()
     # NOTE: _setup_mcp_plugins is an async coroutine because connecting to MCP
@@ -42,23 +434,52 @@ class Agent:
     # from async code after constructing the instance.
         self._setup_execution_settings()
         self.history = ChatHistory()
-        self.history.add_system_message(agent_definition.get("system_message", "You are a helpful assistant. Use your tools to assist users."))
+        self.system_message = agent_definition.get("system_message", "You are a helpful assistant. Use your tools to assist users.")
+        self.history.add_system_message(self.system_message)
+        # Leading messages sent unchanged every turn; kept as a tuple so the prefix is
+        # never mutated and model servers can reuse their cached prefill for it
+        self._static_prefix = tuple(self.history.messages)
+        # Resolve once how assistant turns are recorded instead of probing with try/except per turn
+        self._add_assistant_message = getattr(self.history, "add_assistant_message", self.history.add_system_message)
 
+        # Optional file the conversation is saved to on close and restored from on startup
+        self.history_file = agent_definition.get("history_file")
+        if self.history_file:
+            self.history_file = os.path.expanduser(self.history_file)
+            self._load_history()
+            # Backstop for exits that skip aclose(); holds the agent weakly so it can still be collected
+            self._save_at_exit = functools.partial(_save_history_at_exit, weakref.ref(self))
+            atexit.register(self._save_at_exit)
 
-    def _setup_logging(self, loglevel = logging.INFO):
+        # Seconds a single model call may take before it is abandoned (None waits forever)
+        self.stream_timeout = agent_definition.get("stream_timeout", 300)
+        # Seconds a stream may go without producing a chunk before it is abandoned; opt-in, None disables.
+        # Tools run inside the stream, so a long MCP tool call counts as a stall too
+        self.stream_stall_timeout = agent_definition.get("stream_stall_timeout")
+
+        # Number of trailing user turns sent to the model each turn; opt-in, None sends everything
+        self.history_window = agent_definition.get("history_window")
+
+        # Futures of tool results keyed on (function name, arguments), cleared every turn
+        # unless "cache_tool_results_across_turns" is set
+        self._tool_cache = {}
+        self._tool_cache_across_turns = agent_definition.get("cache_tool_results_across_turns", False)
+        self.kernel.add_filter(FilterTypes.FUNCTION_INVOCATION, self._dedupe_tool_calls)
+
+        # Optional response cache: key -> (expires_at, streamed_text, full_response)
+        # Setting SK_MCP_NO_CACHE in the environment turns it off regardless of the definition
+        self.cache_ttl = agent_definition.get("cache_ttl", 300)
+        self.cache_size = agent_definition.get("cache_size", _CACHE_MAXSIZE)
+        cache_enabled = agent_definition.get("response_cache", False) and os.getenv("SK_MCP_NO_CACHE", "") in ("", "0")
+        self._response_cache = OrderedDict() if cache_enabled else None
+        self._setup_semantic_cache(agent_definition)
 
 
+    def _setup_logging(self, loglevel = logging.INFO):
         # Configure logging levels for different components
-        logging.getLogger("semantic_kernel").setLevel(loglevel)
-        logging.getLogger("semantic_kernel.kernel").setLevel(loglevel)
-        logging.getLogger("semantic_kernel.connectors").setLevel(loglevel)
-    
-        # Set up a basic console handler if not already configured
-        if not logging.getLogger().handlers:
-            logging.basicConfig(
-                level=loglevel,
-                format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-            )
+        for sk_logger in _SK_LOGGERS:
+            sk_logger.setLevel(loglevel)
+        logger.setLevel(loglevel)
 
     def _setup_execution_settings(self):
         # Enable planning
@@ -81,45 +502,122 @@ class Agent:
         
         # Handle if mcp_plugins is already a list
         if not isinstance(mcp_plugins, list):
-            logging.warning(f"mcp_plugins should be a list or dict, got {type(mcp_plugins)}")
+            logger.warning("mcp_plugins should be a list or dict, got %s", type(mcp_plugins))
             return
             
-        for server in mcp_plugins:
-            server_name = server.get("name", "unknown")
-            server_type = server.get("type", "http")  # default to http
-            server_url = server.get("url")
-            
-            if not server_url:
-                logging.warning(f"No URL provided for server {server_name}, skipping")
+        # Connect to every server concurrently so startup costs max(RTT) rather than sum(RTT)
+        results = await asyncio.gather(
+            *[self._connect_mcp_server(server) for server in mcp_plugins],
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                logger.error("Failed to connect to MCP server: %s", result)
                 continue
-            
-            mcp_server = None
-            if "/mcp" in server_url:
-                mcp_server = MCPStreamableHttpPlugin(
-                    name=server_name,
-                    url=server_url,
-                )
-            elif "/sse" in server_url:
-                mcp_server = MCPSsePlugin(
-                    name=server_name,
-                    url=server_url,
-                )
-            else:
-                logging.warning(f"Unknown server type '{server_type}' for server {server_name}, skipping")
+            server_name, mcp_server, tools = result
+            if mcp_server is None:
                 continue
-            
-            if mcp_server:
-                try:
-                    await mcp_server.connect()
-                    self.available_tools = await mcp_server.session.list_tools()
-                    self.kernel.add_plugin(mcp_server)
-                    self.mcp_server_objects.append(mcp_server)
-                    logging.info(f"Successfully connected to MCP server: {server_name} ({server_type})")
-                    await mcp_server.close()
-                except Exception as e:
-                    logging.info(f"Error connecting to {server_name} MCP server.")
-                    logging.error(f"Failed to connect to MCP server {server_name}: {e}")
+            self.available_tools[server_name] = tools
+            self.kernel.add_plugin(mcp_server)
+            self.mcp_server_objects.append(mcp_server)
+
+    async def _connect_mcp_server(self, server: dict):
+        """Connect to a single MCP server; returns (server_name, plugin_or_None, tools_or_None)."""
+        server_name = server.get("name", "unknown")
+        server_url = server.get("url")
 
+        if not server_url:
+            logger.warning("No URL provided for server %s, skipping", server_name)
+            return server_name, None, None
+
+        # An explicit "type" wins; otherwise classify by the final segment of the URL path
+        server_type = server.get("type") or _classify_server_url(server_url)
+        plugin_cls = _PLUGIN_CLASSES.get(server_type)
+        if plugin_cls is None:
+            logger.warning("Unknown server type '%s' for server %s, skipping", server_type, server_name)
+            return server_name, None, None
+        mcp_server = plugin_cls(
+            name=server_name,
+            url=server_url,
+            tools_cache_ttl=server.get("tools_cache_ttl", 300),
+            httpx_client_factory=self._mcp_http_client,
+        )
+
+        try:
+            # The session stays open for the lifetime of the agent; see aclose()
+            # Bounded so one unreachable server cannot hold up startup indefinitely
+            await asyncio.wait_for(mcp_server.connect(), timeout=server.get("connect_timeout", _MCP_TIMEOUT))
+            # Already fetched (or read from disk) while connecting
+            tools = await mcp_server.list_tools()
+            logger.info("Successfully connected to MCP server: %s (%s)", server_name, server_type)
+            return server_name, mcp_server, tools
+        except TimeoutError:
+            logger.error("Timed out connecting to MCP server %s", server_name)
+            # wait_for only stops waiting; the handshake carries on in the plugin's own task
+            connect_task = mcp_server._current_task
+            if connect_task is not None:
+                connect_task.cancel()
+                await asyncio.gather(connect_task, return_exceptions=True)
+                mcp_server._current_task = None
+            return server_name, None, None
+        except Exception as e:
+            logger.info("Error connecting to %s MCP server.", server_name)
+            logger.error("Failed to connect to MCP server %s: %s", server_name, e)
+            return server_name, None, None
+
+    def _mcp_http_client(self, headers=None, timeout=None, auth=None) -> httpx.AsyncClient:
+        """httpx client factory for the MCP transports, backed by the shared connection pool."""
+        return httpx.AsyncClient(
+            headers=headers,
+            # Same default as mcp's own create_mcp_http_client
+            timeout=timeout if timeout is not None else httpx.Timeout(30.0),
+            auth=auth,
+            follow_redirects=True,
+            transport=_SharedTransport(self._http_transport),
+        )
+
+    async def refresh_tools(self, server_name: str | None = None):
+        """Re-list the tools of one (or every) connected MCP server and re-register them with the kernel."""
+        for server in self.mcp_server_objects:
+            if server_name is not None and server.name != server_name:
+                continue
+            await server.load_tools(refresh=True)
+            self.available_tools[server.name] = await server.list_tools()
+            self.kernel.add_plugin(server)
+
+    async def aclose(self):
+        """Close every MCP server session opened by the agent, the shared connection pool and the Ollama clients.
+
+        The conversation is saved to history_file when one is configured.
+        """
+        # Close every session concurrently; a failure or timeout on one does not stop the others
+        results = await asyncio.gather(
+            *[self._close_mcp_server(server) for server in self.mcp_server_objects],
+            return_exceptions=True,
+        )
+        for server, result in zip(self.mcp_server_objects, results):
+            if isinstance(result, BaseException):
+                logger.error("Failed to close server connection %s: %r", server.name, result)
+        self.mcp_server_objects.clear()
+        self.available_tools.clear()
+        await self._http_transport.aclose()
+        if self._ollama_client is not None:
+            await self._ollama_client._client.aclose()
+        if self._embedding_client is not None:
+            await self._embedding_client._client.aclose()
+        if self.history_file:
+            self.save_history()
+            atexit.unregister(self._save_at_exit)
+
+    async def _close_mcp_server(self, server):
+        logger.info("Closing MCP server connection: %s", server.name)
+        await asyncio.wait_for(server.close(), timeout=_MCP_TIMEOUT)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
 
     @classmethod
     async def create(cls, agent_definition: dict):
@@ -127,6 +625,10 @@ class Agent:
 
         Usage:
             agent = await Agent.create(agent_definition)
+
+        MCP sessions stay open until `await agent.aclose()`, or scope them with:
+            async with await Agent.create(agent_definition) as agent:
+                ...
         """
         inst = cls(agent_definition)
         
@@ -136,191 +638,532 @@ class Agent:
         await inst._setup_mcp_plugins(servers_to_setup)
         return inst
 
-    async def run_agent(self, userInput: str, streaming: bool = False):
+    def _setup_semantic_cache(self, agent_definition):
+        """Setup the optional semantic cache that sits behind the exact-match response cache."""
+        self.semantic_cache = None
+        self._embedding_client = None
+        config = agent_definition.get("semantic_cache")
+        if not config or os.getenv("SK_MCP_NO_CACHE", "") not in ("", "0"):
+            return
+        if config is True:
+            config = {}
+        default_host = agent_definition.get("endpoint", "http://localhost:11434")
+        if "azure" in default_host:
+            default_host = "http://localhost:11434"
+        # Owned by the agent so aclose() can close its connections, like the chat client
+        self._embedding_client = OllamaAsyncClient(host=config.get("host", default_host))
+        embedding_service = OllamaTextEmbedding(
+            ai_model_id=config.get("embedding_model", "all-minilm"),
+            client=self._embedding_client,
+        )
+        self.semantic_cache = SemanticCache(
+            embedding_service,
+            threshold=config.get("threshold", 0.95),
+            maxsize=config.get("cache_size", self.cache_size),
+        )
+
+    def _load_history(self):
+        """Restore the conversation saved in history_file, if it was saved for the same model."""
+        try:
+            with open(self.history_file, "rb") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read chat history from %s: %s", self.history_file, e)
+            return
+        if data.get("model_id") != self.chat_completion.ai_model_id:
+            logger.info("Ignoring chat history saved for model %s", data.get("model_id"))
+            return
+        try:
+            saved = ChatHistory.model_validate(data["history"])
+        except (KeyError, ValueError) as e:
+            logger.warning("Could not restore chat history from %s: %s", self.history_file, e)
+            return
+        # The current system message replaces the saved one
+        messages = saved.messages
+        if messages and messages[0].role == AuthorRole.SYSTEM:
+            messages = messages[1:]
+        self.history.messages.extend(messages)
+        logger.info("Restored %d messages from %s", len(messages), self.history_file)
+
+    def save_history(self):
+        """Write the conversation to history_file, tagged with the model it was held with."""
+        if not self.history_file:
+            return
+        data = {
+            "model_id": self.chat_completion.ai_model_id,
+            "history": self.history.model_dump(mode="json", exclude_none=True),
+        }
+        tmp_path = f"{self.history_file}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(_json_dumps(data))
+            os.replace(tmp_path, self.history_file)
+        except OSError as e:
+            logger.warning("Could not save chat history to %s: %s", self.history_file, e)
+
+    async def prewarm(self):
+        """Load the semantic cache's embedding model so the first lookup does not pay for it."""
+        if self.semantic_cache is None:
+            return
+        try:
+            await self.semantic_cache.embed("warm up")
+        except Exception as e:
+            logger.warning("Could not prewarm the embedding model: %s", e)
+
+    async def _lookup_cached_turn(self, chat_history: ChatHistory, userInput: str):
+        """Check the exact-match cache, then the semantic cache, for this turn.
+
+        Returns (cache_key, query_embedding, cached_entry); the first two are None when
+        the corresponding cache is off and are handed back to _store_turn on a miss.
+        The semantic cache only sees the new input, so it is only consulted for the
+        first turn in the window, where no earlier turn can change the answer.
+        """
+        cache_key = query = None
+        if self._response_cache is not None:
+            cache_key = self._response_cache_key(chat_history)
+            cached = self._get_cached_response(cache_key)
+            if cached is not None:
+                return cache_key, query, cached
+        if self.semantic_cache is not None and len(chat_history.messages) == len(self._static_prefix) + 1:
+            try:
+                query = await self.semantic_cache.embed(userInput)
+            except Exception as e:
+                logger.warning("Semantic cache embedding failed, skipping it: %s", e)
+            else:
+                cached = self.semantic_cache.lookup(query, self._semantic_partition())
+                if cached is not None:
+                    logger.info("Semantic cache hit")
+                    if cache_key is not None:
+                        # Backfill the exact-match cache so a repeat of this input skips the embedding
+                        self._cache_response(cache_key, *cached)
+                    return cache_key, query, cached
+        return cache_key, query, None
+
+    def _store_turn(self, cache_key, query, streamed, full_response):
+        """Remember a completed turn in whichever caches are enabled."""
+        if cache_key is not None:
+            self._cache_response(cache_key, streamed, full_response)
+        if query is not None:
+            self.semantic_cache.add(query, (streamed, full_response), self._semantic_partition())
+
+    def _model_context(self) -> dict:
+        """The model id, execution settings and registered tools, which all shape an answer."""
+        tool_names = sorted(
+            f"{plugin_name}-{function_name}"
+            for plugin_name, plugin in self.kernel.plugins.items()
+            for function_name in plugin.functions
+        )
+        return {
+            "model": self.chat_completion.ai_model_id,
+            "settings": self.execution_settings.model_dump(exclude_none=True, exclude={"function_choice_behavior"}),
+            "tools": tool_names,
+        }
+
+    def _response_cache_key(self, chat_history: ChatHistory) -> str:
+        """Hash everything the model would see this turn into a cache key.
+
+        That is the model context and the messages being sent, which end with the
+        user's new input.
+        """
+        key = {
+            **self._model_context(),
+            "messages": [m.to_dict() for m in chat_history.messages],
+        }
+        # blake2b is cheaper than sha256 for short inputs and plenty for cache keys
+        return hashlib.blake2b(_json_dumps(key), digest_size=16).hexdigest()
 
-        # Add user input to the history
+    def _semantic_partition(self) -> str:
+        """Semantic cache partition for the current model context, including the system message."""
+        key = {
+            **self._model_context(),
+            "prefix": [m.to_dict() for m in self._static_prefix],
+        }
+        return hashlib.blake2b(_json_dumps(key), digest_size=16).hexdigest()
+
+    def _get_cached_response(self, key: str):
+        entry = self._response_cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._response_cache[key]
+            return None
+        self._response_cache.move_to_end(key)
+        return entry[1:]
+
+    def _cache_response(self, key: str, streamed, full_response):
+        self._response_cache[key] = (time.monotonic() + self.cache_ttl, streamed, full_response)
+        self._response_cache.move_to_end(key)
+        # Evict least recently used entries so the cache cannot grow without bound
+        while len(self._response_cache) > self.cache_size:
+            self._response_cache.popitem(last=False)
+
+    def _model_history(self) -> ChatHistory:
+        """Build the history sent to the model: the static prefix plus the last `history_window` turns.
+
+        self.history keeps the whole conversation for callers; only this window is
+        re-sent, so per-turn prompt size stops growing with the conversation. Tool
+        calls made during the turn are appended to the window, not to self.history.
+        """
+        messages = self.history.messages
+        start = len(self._static_prefix)
+        if self.history_window is not None:
+            turns = 0
+            for i in range(len(messages) - 1, start - 1, -1):
+                if messages[i].role == AuthorRole.USER:
+                    turns += 1
+                    if turns == self.history_window:
+                        start = i
+                        break
+        return ChatHistory(messages=[*self._static_prefix, *messages[start:]])
+
+    async def _dedupe_tool_calls(self, context: FunctionInvocationContext, next):
+        """Kernel filter that serves repeated tool calls with identical arguments from the tool cache.
+
+        A call that is still running is shared too, so identical calls the model makes
+        in parallel hit the server once.
+        """
+        key = (context.function.fully_qualified_name, _json_dumps(dict(context.arguments), sort_keys=True))
+        future = self._tool_cache.get(key)
+        if future is not None:
+            result = await asyncio.shield(future)
+            if result is not None:
+                logger.info("Reusing result of %s from an identical earlier call", key[0])
+                context.result = result
+                return
+        future = asyncio.get_running_loop().create_future()
+        self._tool_cache[key] = future
+        try:
+            await next(context)
+        finally:
+            # Calls waiting on a failed call go on to make it themselves
+            future.set_result(context.result)
+            if context.result is None and self._tool_cache.get(key) is future:
+                del self._tool_cache[key]
+
+    def _start_turn(self, userInput: str):
+        """Add the user's message to the history and reset per-turn state."""
         self.history.add_user_message(userInput)
+        if not self._tool_cache_across_turns:
+            self._tool_cache.clear()
+
+    def _replay_cached_turn(self, full_response: dict):
+        """Record the assistant side of a turn served from the response cache in the history."""
+        logger.info("Serving agent response from cache")
+        assistant_text = self._assistant_text(full_response)
+        if assistant_text:
+            self._add_assistant_message(assistant_text)
+
+    def _finish_turn(self, acc: _TurnAccum) -> dict:
+        """Add what the turn produced to the history as one assistant message and return it as a dict."""
+        # The text is buffered while streaming and read out exactly once here
+        full_response = acc.to_dict()
+        assistant_text = self._assistant_text(full_response)
+        if assistant_text:
+            self._add_assistant_message(assistant_text)
+        return full_response
+
+    @staticmethod
+    def _assistant_text(full_response: dict) -> str:
+        """Reconstruct a single assistant message from a finished turn's thoughts, messages and tool calls."""
+        if not (full_response['thoughts'] or full_response['messages'] or full_response['tool_calls']):
+            return ""
+
+        # Written into one buffer rather than collected into a list and joined
+        buf = io.StringIO()
+        sep = ""
+        for part in (full_response['thoughts'], full_response['messages']):
+            if part:
+                buf.write(sep)
+                buf.write(part)
+                sep = "\n\n"
+        if full_response['tool_calls']:
+            # represent tool calls as a JSON list/dict
+            buf.write(sep)
+            buf.write(_json_dumps(full_response['tool_calls']).decode())
+
+        return buf.getvalue().strip()
+
+    async def run_agent(self, userInput: str, streaming: bool = False):
+        """Run one turn of the conversation.
+
+        With streaming=False the non-streaming chat API is awaited directly and a dict
+        is returned with "thoughts" (str), "messages" (str) and "tool_calls" (list).
+        With streaming=True the async generator from run_agent_stream is returned instead.
+        """
+        if streaming:
+            return self.run_agent_stream(userInput, streaming=True)
+
+        self._start_turn(userInput)
+        chat_history = self._model_history()
+        first_new_message = len(chat_history.messages)
+
+        cache_key, query, cached = await self._lookup_cached_turn(chat_history, userInput)
+        if cached is not None:
+            _, full_response = cached
+            self._replay_cached_turn(full_response)
+            return dict(full_response)
+
+        acc = _TurnAccum()
+
+        try:
+            logger.info("Running agent with user input: %s", userInput)
+            async with asyncio.timeout(self.stream_timeout):
+                response = await self.chat_completion.get_chat_message_content(
+                    chat_history=chat_history,
+                    settings=self.execution_settings,
+                    kernel=self.kernel,
+                )
+
+            # Function results land in the history while tools are auto-invoked
+            for message in chat_history.messages[first_new_message:]:
+                for item in message.items:
+                    if item.content_type == "function_result":
+                        acc.tool_calls.append(item.inner_content)
+
+            if response is not None:
+                # Only Ollama responses carry a separate message object with thinking text
+                thinking, _ = _ollama_parts(response.inner_content)
+                if thinking:
+                    acc.thoughts.write(str(thinking))
+                if response.content:
+                    acc.messages.write(response.content)
+
+            full_response = self._finish_turn(acc)
+            self._store_turn(cache_key, query, None, full_response)
+        except TimeoutError:
+            logger.warning("Model call timed out after %ss; cancelled", self.stream_timeout)
+            full_response = acc.to_dict()
+        except Exception as e:
+            _log_exc("The chat message processing failed. %s", e)
+            full_response = acc.to_dict()
+
+        return full_response
+
+    async def run_agent_stream(self, userInput: str, streaming: bool = True):
+        """Run one turn of the conversation through the streaming chat API.
+
+        With streaming=True the response is yielded as coalesced text pieces; with
+        streaming=False a single dict shaped like run_agent's result is yielded at the end.
+        """
+
+        self._start_turn(userInput)
+        chat_history = self._model_history()
+
+        cache_key, query, cached = await self._lookup_cached_turn(chat_history, userInput)
+        if cached is not None:
+            streamed, full_response = cached
+            self._replay_cached_turn(full_response)
+            if streaming:
+                if streamed:
+                    yield streamed
+                elif full_response['messages']:
+                    yield full_response['messages']
+            else:
+                yield dict(full_response)
+            return
 
         # Accumulate content so we can add a single message to history at the end
-        full_response = {
-            "thoughts": [],
-            "tool_calls": [],
-            "messages": []
-        }
+        acc = _TurnAccum()
+        pending = []
+        out_pieces = pending if streaming else None
 
         try:
-            logging.info(f"Running agent with user input: {userInput}")
-            for server in self.mcp_server_objects:
-                await server.connect()
+            logger.info("Running agent with user input: %s", userInput)
             response = self.chat_completion.get_streaming_chat_message_content(
-                messages=userInput,
-                chat_history=self.history,
+                chat_history=chat_history,
                 settings=self.execution_settings,
                 kernel=self.kernel,
             )
 
-            thoughts = 0
-            tools = 0
-            message = 0
-
-            async for chunk in response:
-                if isinstance(self.chat_completion, AzureChatCompletion):
-
-                                        # messages
-                    if "message" in chunk.content_type and len(chunk.content) > 0:
-                        if message == 0:
-                            message = message + 1
-                            thoughts = 0
-                            tools = 0
-                            if streaming: yield str("\n--- Agent Message ---")
-                        if streaming: yield str(chunk.content)
-                        # accumulate a best-effort message representation
-
-                        if chunk.inner_content is not None:
-                            full_response['messages'].append(str(chunk.content))
-                    #  # thoughts
-                    # if "thoughts" in chunk.tag:
-                    #     if thoughts == 0:
-                    #         thoughts = thoughts + 1
-                    #         tools = 0
-                    #         message = 0
-                    #         if streaming: yield str("\n--- Agent Thoughts ---")
-                    #     thinking = chunk.inner_content['message'].thinking
-                    #     # preserve if streaming: yield str behavior
-                    #     if streaming: yield str(thinking)
-                    #     # accumulate
-                    #     try:
-                    #         full_response['thoughts'].append(str(thinking))
-                    #     except Exception:
-                    #         full_response['thoughts'].append(repr(thinking))
-
-                    # tools
-                    elif len(chunk.items) > 0:
-                        if tools == 0:
-                            tools = tools + len(chunk.items)
-                            message = 0
-                            thoughts = 0
-                            if streaming: yield str("\n--- Agent Tools ---")
-                        tool_calls = chunk.items
-                        for tool in tool_calls:
-                            if tool.content_type == "function_result":
-                                try:
-                                    full_response['tool_calls'].append(tool.inner_content)
-                                except Exception as e:
-                                    logging.error("Error occurred while processing tool calls: %s", e)
-                    else:
-                        if chunk.finish_reason == 'tool_calls':
-                            # This is a special case where the Azure Chat Completion API returns a tool call
-                            # as a separate chunk with no content, so we skip it.
-                            continue
-                        else:
-                            logging.debug("somehow made it here: ", chunk)
+            section = SECTION_NONE
+            chunk_handler = self._chunk_handler
 
-                
-                else: # Ollama Chat Completion
-                    # thoughts
-                    if chunk.inner_content is not None and chunk.inner_content.get('message') is not None and chunk.inner_content['message'].thinking is not None:
-                        if thoughts == 0:
-                            thoughts = thoughts + 1
-                            tools = 0
-                            message = 0
-                            if streaming: yield str("\n--- Agent Thoughts ---")
-                        thinking = chunk.inner_content['message'].thinking
-                        # preserve if streaming: yield str behavior
-                        if streaming: yield str(thinking)
-                        # accumulate
+            # Flushed text is kept when caching so a hit can replay the same stream
+            streamed = io.StringIO() if streaming and (cache_key is not None or query is not None) else None
+            loop = asyncio.get_running_loop()
+            last_flush = loop.time()
+            unflushed = 0
+
+            # One long-lived task reads the model stream into a queue, so buffered text
+            # can be flushed while the model is quiet without touching the stream from
+            # this task. A consumer that stops iterating closes this generator, which
+            # cancels the reader and so closes the model stream.
+            queue = asyncio.Queue()
+            reader = asyncio.create_task(
+                _drain_into(_until_deadline(response, self.stream_timeout, self.stream_stall_timeout), queue)
+            )
+            try:
+                while True:
+                    if pending:
                         try:
-                            full_response['thoughts'].append(str(thinking))
-                        except Exception:
-                            full_response['thoughts'].append(repr(thinking))
-
-                    # tools
-                    elif chunk.inner_content is not None and chunk.inner_content.get('message') is not None and chunk.inner_content['message'].tool_calls is not None:
-                        if tools == 0:
-                            tools = tools + 1
-                            message = 0
-                            thoughts = 0
-                            if streaming: yield str("\n--- Agent Tools ---")
-                        tool_calls = chunk.inner_content['message'].tool_calls
-                        for tool in tool_calls:
-                            if streaming: yield str(f"Tool: {tool.function.name}")
-                            if streaming: yield str(f"Arguments: {tool.function.arguments}")
-                            # accumulate
-                            try:
-                                full_response['tool_calls'].append({tool.function.name: tool.function.arguments})
-                            except Exception:
-                                full_response['tool_calls'].append({"generic": str(tool_calls)})
-                    # messages
-                    elif len(chunk.content) > 0:
-                        if message == 0:
-                            message = message + 1
-                            thoughts = 0
-                            tools = 0
-                            if streaming: yield str("\n--- Agent Message ---")
-                        if streaming: yield str(chunk)
-                        # accumulate a best-effort message representation
-
-                        if chunk.inner_content is not None:
-                            full_response['messages'].append(str(chunk.content))
-
-
-
-
-            # Reconstruct a single assistant message from the accumulated pieces
-            assistant_parts = []
-            if full_response.get('thoughts'):
-                full_response['thoughts'] = "".join(full_response['thoughts'])
-                assistant_parts.append("\n".join(full_response['thoughts']))
-            if full_response.get('messages'):
-                full_response['messages'] = "".join(full_response['messages'])
-                assistant_parts.append("\n".join(full_response['messages']))
-            if full_response.get('tool_calls'):
-                # represent tool calls as a stringified list/dict
-                assistant_parts.append(str(full_response['tool_calls']))
-
-            assistant_text = "\n\n".join([p for p in assistant_parts if p]).strip()
-            if assistant_text:
-                # Try to add as an assistant message; fall back to system message if method isn't available
-                try:
-                    self.history.add_assistant_message(assistant_text)
-                except Exception:
-                    self.history.add_system_message(assistant_text)
-            for server in self.mcp_server_objects:
-                # Attempt to close the server connection gracefully
-                try:
-                    logging.info(f"Closing MCP server connection: {server.name}")
-                    await server.close()
-                except Exception as e:
-                    logging.exception(f"Failed to close server connection: {e}")
+                            async with asyncio.timeout_at(last_flush + _FLUSH_INTERVAL):
+                                chunk = await queue.get()
+                        except TimeoutError:
+                            chunk = None
+                    else:
+                        chunk = await queue.get()
+                    if chunk is _STREAM_END:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise chunk
+
+                    if chunk is not None:
+                        previous = section
+                        section = chunk_handler(chunk, section, acc, out_pieces)
+                        unflushed += 1
+
+                    # Streamed text is coalesced and yielded in batches rather than per token;
+                    # every yield from an async generator is a trip through the loop. A batch
+                    # is also flushed when the section changes or the stream goes quiet.
+                    if pending and (
+                        chunk is None
+                        or section != previous
+                        or unflushed >= _FLUSH_CHUNKS
+                        or loop.time() - last_flush >= _FLUSH_INTERVAL
+                    ):
+                        out = "".join(pending)
+                        pending.clear()
+                        unflushed = 0
+                        last_flush = loop.time()
+                        if streamed is not None:
+                            streamed.write(out)
+                        yield out
+            finally:
+                reader.cancel()
+                await asyncio.wait([reader])
+
+            if pending:
+                out = "".join(pending)
+                pending.clear()
+                if streamed is not None:
+                    streamed.write(out)
+                yield out
+
+            full_response = self._finish_turn(acc)
+            self._store_turn(cache_key, query, streamed.getvalue() if streamed is not None else None, full_response)
+        except TimeoutError:
+            # The stream is already closed; keep what arrived, but do not cache a cut-off answer
+            logger.warning("Model stream stalled or ran past its timeout; cancelled")
+            if pending:
+                yield "".join(pending)
+            full_response = self._finish_turn(acc)
         except Exception as e:
             # Best-effort cleanup; ignore errors
-            logging.exception(f"The chat message processing failed. {e}")
+            _log_exc("The chat message processing failed. %s", e)
+            full_response = acc.to_dict()
 
         if not streaming:
-            yield str(full_response)
-            # return full_response
+            yield full_response
+
+    def _handle_azure_chunk(self, chunk, section, acc, pending):
+        """Record one Azure streaming chunk and return the new section.
+
+        Streamable text is appended to `pending` unless it is None.
+        """
+        # chunk.content is a property that scans chunk.items, so read it once
+        c = chunk.content
+        # messages
+        if c and "message" in chunk.content_type:
+            if section != SECTION_MSG:
+                section = SECTION_MSG
+                if pending is not None: pending.append(_HEADERS[section])
+            if pending is not None: pending.append(c)
+            # accumulate a best-effort message representation
+
+            if chunk.inner_content is not None:
+                acc.messages.write(c)
+
+        # tools
+        elif chunk.items:
+            if section != SECTION_TOOLS:
+                section = SECTION_TOOLS
+                if pending is not None: pending.append(_HEADERS[section])
+            for tool in chunk.items:
+                if tool.content_type == "function_result":
+                    ic = getattr(tool, 'inner_content', None)
+                    if ic is not None:
+                        acc.tool_calls.append(ic)
+        else:
+            # The Azure Chat Completion API returns a tool call as a separate
+            # chunk with no content (finish_reason == 'tool_calls'), so we skip it.
+            if chunk.finish_reason != 'tool_calls':
+                logger.debug("somehow made it here: %r", chunk)
+        return section
+
+    def _handle_ollama_chunk(self, chunk, section, acc, pending):
+        """Record one Ollama streaming chunk and return the new section.
+
+        Streamable text is appended to `pending` unless it is None.
+        """
+        # Resolve the raw Ollama message once instead of re-walking inner_content per branch
+        ic = chunk.inner_content
+        thinking, tool_calls = _ollama_parts(ic)
+
+        # thoughts
+        if thinking is not None:
+            if section != SECTION_THOUGHTS:
+                section = SECTION_THOUGHTS
+                if pending is not None: pending.append(_HEADERS[section])
+            # Ollama sends thinking as str; only stringify anything else
+            if not isinstance(thinking, str):
+                thinking = str(thinking)
+            if pending is not None: pending.append(thinking)
+            acc.thoughts.write(thinking)
+
+        # tools
+        elif tool_calls is not None:
+            if section != SECTION_TOOLS:
+                section = SECTION_TOOLS
+                if pending is not None: pending.append(_HEADERS[section])
+            for tool in tool_calls:
+                if pending is not None: pending.append(f"Tool: {tool.function.name}\n")
+                if pending is not None: pending.append(f"Arguments: {_json_dumps(tool.function.arguments).decode()}\n")
+        # tool results, which SK streams as a separate message once the tools have run;
+        # recorded like the Azure and non-streaming paths so tool_calls always holds results
+        elif chunk.role == AuthorRole.TOOL:
+            for item in chunk.items:
+                if item.content_type == "function_result" and item.inner_content is not None:
+                    acc.tool_calls.append(item.inner_content)
+        # messages
+        elif c := chunk.content:
+            if section != SECTION_MSG:
+                section = SECTION_MSG
+                if pending is not None: pending.append(_HEADERS[section])
+            # str(chunk) is just chunk.content, so stream the already-bound string
+            if pending is not None: pending.append(c)
+            # accumulate a best-effort message representation
+
+            if ic is not None:
+                acc.messages.write(c)
+        return section
 
     def _setup_chat_completion(self, agent_definition):
         """Setup the chat completion service based on agent definition."""
+        self._ollama_client = None
         try:
             if "env_file_path" in agent_definition:
-                logging.info(f"Loading environment variables from {agent_definition['env_file_path']}")
-                # Load environment variables from .env file
-                load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), agent_definition['env_file_path']))
+                logger.info("Loading environment variables from %s", agent_definition['env_file_path'])
+                # Load environment variables from .env file (once per path)
+                _load_env_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), agent_definition['env_file_path']))
 
                 # Override agent_definition with environment variables if they exist
-                if os.getenv("AZURE_OPENAI_ENDPOINT"):
-                    agent_definition["endpoint"] = os.getenv("AZURE_OPENAI_ENDPOINT")
-                if os.getenv("AZURE_OPENAI_API_KEY"):
-                    agent_definition["api_key"] = os.getenv("AZURE_OPENAI_API_KEY")
-                if os.getenv("AZURE_OPENAI_MODEL"):
-                    agent_definition["deployment_name"] = os.getenv("AZURE_OPENAI_MODEL")
-                if os.getenv("OPENAI_API_VERSION"):
-                    agent_definition["api_version"] = os.getenv("OPENAI_API_VERSION")\
-                    
-                logging.info(f"Azure OpenAI endpoint: {agent_definition.get('endpoint', None)}")
+                overrides = {
+                    key: value
+                    for key, value in (
+                        ("endpoint", os.getenv("AZURE_OPENAI_ENDPOINT")),
+                        ("api_key", os.getenv("AZURE_OPENAI_API_KEY")),
+                        ("deployment_name", os.getenv("AZURE_OPENAI_MODEL")),
+                        ("api_version", os.getenv("OPENAI_API_VERSION")),
+                    )
+                    if value
+                }
+                agent_definition.update(overrides)
+
+                logger.info("Azure OpenAI endpoint: %s", agent_definition.get('endpoint', None))
             if "azure" in agent_definition.get("endpoint", ""):
-                logging.info("Configuring Azure OpenAI Chat Completion")
+                logger.info("Configuring Azure OpenAI Chat Completion")
                 
                 self.chat_completion = AzureChatCompletion(
                     service_id=agent_definition.get("service_id", None),
@@ -340,16 +1183,116 @@ class Agent:
                 )
 
             else:
-                logging.info("Configuring Ollama Chat Completion")
+                logger.info("Configuring Ollama Chat Completion")
+                # One client for the agent's lifetime keeps its connections alive between turns; see aclose()
+                self._ollama_client = OllamaAsyncClient(
+                    host=agent_definition.get("endpoint", "http://localhost:11434"), # Default to local Ollama Instance
+                    timeout=None,
+                    limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=300),
+                )
                 self.chat_completion = OllamaChatCompletion(
                     ai_model_id=agent_definition.get("deployment_name", "gpt-oss:20b"),
-                    host=agent_definition.get("endpoint", "http://localhost:11434"), # Default to local Ollama Instance
+                    client=self._ollama_client,
                 )
-            logging.info(f"Chat completion service configured: {self.chat_completion.__class__.__name__}")
+            logger.info("Chat completion service configured: %s", self.chat_completion.__class__.__name__)
+        except Exception as e:
+            logger.error("Failed to setup chat completion: %s", e)
+
+
+# File object reading piped stdin for _blocking_input, opened on first use
+_stdin_pipe = None
+
+
+def _blocking_input(prompt: str) -> str:
+    """input(), except that piped stdin is read through a file object of its own.
+
+    A daemon thread blocked on sys.stdin's buffer holds its lock, which aborts the
+    interpreter at shutdown; input() on a terminal takes no such lock.
+    """
+    global _stdin_pipe
+    if sys.stdin.isatty():
+        return input(prompt)
+    if _stdin_pipe is None:
+        _stdin_pipe = open(sys.stdin.fileno(), encoding=sys.stdin.encoding, closefd=False)
+    sys.stdout.write(prompt)
+    sys.stdout.flush()
+    line = _stdin_pipe.readline()
+    if not line:
+        raise EOFError
+    return line.removesuffix("\n")
+
+
+async def _read_line(prompt: str) -> str:
+    """Read a line with input() on a daemon thread while the loop keeps serving the MCP sessions.
+
+    Unlike asyncio.to_thread, a prompt still waiting at Ctrl+C or exit does not hold up
+    the executor shutdown, and so the process. EOFError is raised at end of input.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(line, exc):
+        if future.done():  # the caller was cancelled meanwhile
+            return
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(line)
+
+    def read():
+        line = exc = None
+        try:
+            line = _blocking_input(prompt)
         except Exception as e:
-            logging.error(f"Failed to setup chat completion: {e}")
+            exc = e
+        with contextlib.suppress(RuntimeError):  # the loop has already closed
+            loop.call_soon_threadsafe(settle, line, exc)
+
+    threading.Thread(target=read, name="stdin-reader", daemon=True).start()
+    return await future
+
+
+async def _demo(agent_name: str = "Ollama_agent", question: str | None = None):
+    """Chat with an agent from agent_definition.json, streaming each answer.
+
+    With `question` the agent answers it once, writes the result dict to stdout as
+    JSON and exits; otherwise it prompts until an empty line, "exit" or end of input.
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "agent_definition.json"), encoding="utf-8") as f:
+        agent_definition = json.load(f)
+
+    async with await Agent.create(agent_definition[agent_name]) as agent:
+        # Loads the embedding model while the user is still typing
+        prewarm = asyncio.create_task(agent.prewarm())
+        # Flush every piece on a terminal; when piped, let stdout's buffer batch the writes
+        write, flush = sys.stdout.write, sys.stdout.flush
+        interactive = sys.stdout.isatty()
+        if question is not None:
+            result = await agent.run_agent(question)
+            # Encoded straight to bytes; no intermediate str for a large result
+            sys.stdout.buffer.write(_json_dumps(result, indent=True) + b"\n")
+            flush()
+        while question is None:
+            try:
+                user_input = await _read_line("User > ")
+            except EOFError:
+                break
+            if user_input.strip() in ("", "exit"):
+                break
+            async for piece in agent.run_agent_stream(user_input):
+                write(piece)
+                if interactive:
+                    flush()
+            write("\n")
+            flush()
+        prewarm.cancel()
 
 
-# Run the main function
+# Run the demo
 if __name__ == "__main__":
-    resp = asyncio.run(Agent())
+    try:
+        import uvloop
+    except ImportError:  # uvloop is optional; fall back to the default event loop
+        uvloop = None
+    with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+        runner.run(_demo(*sys.argv[1:3]))